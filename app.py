@@ -1,29 +1,204 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, make_response
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response, stream_with_context, abort
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+from flask_caching import Cache
+from flask_session import Session
+from celery import Celery, Task, shared_task
+from celery.result import AsyncResult
 from models import db, User, Transaction, UserSettings
 from config import Config
-from datetime import datetime, timedelta
+from sqlalchemy import select, func, extract, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import raiseload, load_only
+from jinja2 import FileSystemBytecodeCache
+from datetime import datetime, date, timedelta
+from contextlib import suppress
 import csv
-from io import StringIO
+import hashlib
+import os
+import time
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
+# Share compiled templates between worker processes and restarts
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
 # Initialize extensions
 db.init_app(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Please log in to access this page.'
+cache = Cache(app)
+
+if app.config['SESSION_TYPE']:
+    Session(app)
+
+def celery_init_app(app):
+    class FlaskTask(Task):
+        def __call__(self, *args, **kwargs):
+            with app.app_context():
+                return self.run(*args, **kwargs)
+    
+    celery_app = Celery(app.name, task_cls=FlaskTask)
+    celery_app.config_from_object(app.config['CELERY'])
+    celery_app.set_default()
+    app.extensions['celery'] = celery_app
+    return celery_app
+
+# Start a worker with: celery -A app.celery worker
+celery = celery_init_app(app) if app.config['REDIS_URL'] else None
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Flask-Login keeps the result on g for the rest of the request
+    return db.session.get(User, int(user_id))
+
+class Echo:
+    """File-like object that hands back whatever csv.writer writes to it."""
+    def write(self, value):
+        return value
+
+def generate_csv(user_id):
+    """Yield a user's transactions as CSV lines, newest first."""
+    stmt = select(Transaction.date, Transaction.category, Transaction.description, Transaction.amount)\
+        .filter_by(user_id=user_id).order_by(Transaction.date.desc())
+    
+    writer = csv.writer(Echo())
+    yield writer.writerow(('Date', 'Category', 'Description', 'Amount'))
+    
+    # f'{:.2f}' is faster than round() here, since csv.writer would call
+    # repr() on the float, and it keeps the two decimal places
+    for t in db.session.execute(stmt).yield_per(1000):
+        yield writer.writerow((t.date.isoformat(), t.category, t.description, f'{t.amount:.2f}'))
+
+def export_path(job_id):
+    return os.path.join(app.instance_path, 'exports', f'{job_id}.csv')
+
+def prune_exports(max_age):
+    """Delete export files that were never downloaded within max_age seconds."""
+    export_dir = os.path.dirname(export_path('x'))
+    cutoff = time.time() - max_age
+    for entry in os.scandir(export_dir):
+        # Another task may prune the same file; cleanup must never fail an export
+        with suppress(OSError):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+
+@shared_task(bind=True, ignore_result=False)
+def build_export(self, user_id):
+    """Write a user's CSV export to disk and return the owner's id."""
+    path = export_path(self.request.id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    prune_exports(app.config['CELERY']['result_expires'].total_seconds())
+    with open(path, 'w', newline='') as f:
+        f.writelines(generate_csv(user_id))
+    return user_id
+
+def get_transactions_version(user_id):
+    """Return a (count, MAX(created_at)) pair that changes whenever the user's transactions do.
+    
+    Inserts move MAX(created_at) forward and deletes lower the count, so
+    together they identify the current state without reading every row.
+    """
+    return tuple(db.session.execute(
+        select(func.count(Transaction.id), func.max(Transaction.created_at))
+        .where(Transaction.user_id == user_id)
+    ).one())
+
+@cache.memoize(timeout=300)
+def get_spending_summary(user_id, version, today):
+    """Return a user's spending totals as of today, summed in the database.
+    
+    version comes from get_transactions_version(), so any change to the
+    user's transactions produces a new cache key in every worker.
+    """
+    # Category breakdown
+    rows = db.session.execute(
+        select(Transaction.category, func.sum(Transaction.amount))
+        .where(Transaction.user_id == user_id)
+        .group_by(Transaction.category)
+    )
+    categories = {category: total for category, total in rows}
+    
+    # Spending over the last 30 days
+    thirty_days_ago = today - timedelta(days=30)
+    last_30_days = db.session.execute(
+        select(func.coalesce(func.sum(Transaction.amount), 0))
+        .where(Transaction.user_id == user_id,
+               Transaction.date >= thirty_days_ago)
+    ).scalar()
+    
+    # Spending per (year, month), starting from the oldest month on the dashboard
+    first_month = (today - timedelta(days=30*5)).replace(day=1)
+    year = extract('year', Transaction.date)
+    month = extract('month', Transaction.date)
+    rows = db.session.execute(
+        select(year, month, func.sum(Transaction.amount))
+        .where(Transaction.user_id == user_id,
+               Transaction.date >= first_month)
+        .group_by(year, month)
+    )
+    by_month = {(int(y), int(m)): total for y, m, total in rows}
+    
+    return {
+        'categories': categories,
+        'last_30_days': last_30_days,
+        'by_month': by_month
+    }
+
+def get_transactions(user_id, *columns):
+    """Return a user's transactions, newest first, fetched in batches.
+    
+    If columns are given, only those (plus the primary key) are loaded.
+    """
+    stmt = select(Transaction).filter_by(user_id=user_id).order_by(Transaction.date.desc())
+    if columns:
+        stmt = stmt.options(load_only(*columns))
+    if app.debug or app.testing:
+        # Turn accidental lazy loads (N+1 queries) into errors during development
+        stmt = stmt.options(raiseload('*'))
+    return db.session.scalars(stmt.execution_options(yield_per=1000))
+
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # WAL lets reads run alongside a write and batches fsyncs across commits
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+def transactions_etag(user_id, *version):
+    """Return an ETag for a response built from the given data version."""
+    key = ':'.join(str(part) for part in (user_id, *version))
+    return hashlib.md5(key.encode()).hexdigest()
+
+def set_cache_headers(response, etag):
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = 30
+    return response
 
 # Create tables
 with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', set_sqlite_pragma)
+    
     db.create_all()
 
+@app.cli.command('create-indexes')
+def create_indexes():
+    """Add indexes missing from tables that create_all() skipped as existing."""
+    postgres = db.engine.dialect.name == 'postgresql'
+    
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for table in (Transaction.__table__, UserSettings.__table__):
+            for index in table.indexes:
+                if postgres:
+                    # Build without blocking writes to the table
+                    index.dialect_options['postgresql']['concurrently'] = True
+                index.create(conn, checkfirst=True)
+
 # ==================== Routes ====================
 
 # Authentication Routes
@@ -45,6 +220,11 @@ def login():
         user = User.query.filter_by(email=email).first()
         
         if user and user.check_password(password):
+            # Upgrade legacy or outdated hashes while we have the plain password
+            if user.password_needs_rehash():
+                user.set_password(password)
+                db.session.commit()
+            
             login_user(user, remember=True)
             flash('Welcome back to FinWise!', 'success')
             next_page = request.args.get('next')
@@ -73,20 +253,20 @@ def signup():
             flash('Passwords do not match', 'error')
             return render_template('signup.html')
         
-        if User.query.filter_by(email=email).first():
-            flash('Email already registered', 'error')
-            return render_template('signup.html')
-        
         user = User(name=name, email=email)
         user.set_password(password)
         
-        db.session.add(user)
-        db.session.commit()
+        # Create default settings in the same transaction
+        user.settings = UserSettings()
         
-        # Create default settings
-        settings = UserSettings(user_id=user.id)
-        db.session.add(settings)
-        db.session.commit()
+        # Rely on the unique constraint rather than checking for the email first
+        db.session.add(user)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash('Email already registered', 'error')
+            return render_template('signup.html')
         
         flash('Account created successfully! Please log in.', 'success')
         return redirect(url_for('login'))
@@ -104,21 +284,10 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    # Get user's transactions
-    transactions = Transaction.query.filter_by(user_id=current_user.id).all()
-    
-    # Calculate metrics
-    total_spent = sum(t.amount for t in transactions)
-    
-    # Get transactions from last 30 days
-    thirty_days_ago = datetime.now() - timedelta(days=30)
-    recent_transactions = [t for t in transactions if t.date >= thirty_days_ago.date()]
-    monthly_spending = sum(t.amount for t in recent_transactions)
-    
-    # Category breakdown
-    categories = {}
-    for t in transactions:
-        categories[t.category] = categories.get(t.category, 0) + t.amount
+    uid = current_user.id
+    summary = get_spending_summary(uid, get_transactions_version(uid), date.today())
+    monthly_spending = summary['last_30_days']
+    categories = summary['categories']
     
     # Calculate savings (mock data)
     current_balance = 10000
@@ -133,6 +302,8 @@ def dashboard():
 @app.route('/expenses', methods=['GET', 'POST'])
 @login_required
 def expenses():
+    uid = current_user.id
+    
     if request.method == 'POST':
         amount = float(request.form.get('amount'))
         category = request.form.get('category')
@@ -140,11 +311,11 @@ def expenses():
         date_str = request.form.get('date')
         
         transaction = Transaction(
-            user_id=current_user.id,
+            user_id=uid,
             amount=amount,
             category=category,
             description=description,
-            date=datetime.strptime(date_str, '%Y-%m-%d').date()
+            date=date.fromisoformat(date_str)
         )
         
         db.session.add(transaction)
@@ -153,14 +324,17 @@ def expenses():
         flash('Expense added successfully!', 'success')
         return redirect(url_for('expenses'))
     
-    # Get all transactions for current user
-    transactions = Transaction.query.filter_by(user_id=current_user.id)\
-        .order_by(Transaction.date.desc()).all()
-    
     # Calculate summary
-    total_spent = sum(t.amount for t in transactions)
-    highest_expense = max([t.amount for t in transactions]) if transactions else 0
-    transaction_count = len(transactions)
+    transaction_count, total_spent, highest_expense = db.session.execute(
+        select(func.count(Transaction.id),
+               func.coalesce(func.sum(Transaction.amount), 0),
+               func.coalesce(func.max(Transaction.amount), 0))
+        .filter_by(user_id=uid)
+    ).one()
+    
+    # Get all transactions for current user, with just the columns the table shows
+    transactions = get_transactions(uid, Transaction.date, Transaction.category,
+                                    Transaction.description, Transaction.amount)
     
     return render_template('expenses.html',
                          transactions=transactions,
@@ -171,9 +345,11 @@ def expenses():
 @app.route('/expenses/delete/<int:transaction_id>', methods=['POST'])
 @login_required
 def delete_expense(transaction_id):
+    uid = current_user.id
+    
     transaction = Transaction.query.get_or_404(transaction_id)
     
-    if transaction.user_id != current_user.id:
+    if transaction.user_id != uid:
         flash('Unauthorized action', 'error')
         return redirect(url_for('expenses'))
     
@@ -191,11 +367,12 @@ def learn():
 @app.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
-    user_settings = UserSettings.query.filter_by(user_id=current_user.id).first()
+    # Loaded together with the user, see User.settings
+    user_settings = current_user.settings
     
     if not user_settings:
-        user_settings = UserSettings(user_id=current_user.id)
-        db.session.add(user_settings)
+        user_settings = UserSettings()
+        current_user.settings = user_settings
         db.session.commit()
     
     if request.method == 'POST':
@@ -217,52 +394,123 @@ def settings():
     
     return render_template('settings.html', user_settings=user_settings)
 
-@app.route('/export_data')
+@app.route('/export_data', methods=['POST'])
 @login_required
 def export_data():
-    transactions = Transaction.query.filter_by(user_id=current_user.id)\
-        .order_by(Transaction.date.desc()).all()
+    uid = current_user.id
     
-    if not transactions:
+    if not Transaction.query.filter_by(user_id=uid).first():
         flash('No data to export', 'info')
         return redirect(url_for('expenses'))
     
-    # Create CSV
-    si = StringIO()
-    writer = csv.writer(si)
-    writer.writerow(['Date', 'Category', 'Description', 'Amount'])
+    # Hand large exports to a Celery worker so this worker is freed immediately
+    if 'celery' in app.extensions:
+        job = build_export.delay(uid)
+        
+        # Remember who owns the job for as long as Celery keeps its result
+        cache.set(f'export:{job.id}', uid,
+                  timeout=int(app.config['CELERY']['result_expires'].total_seconds()))
+        
+        status_url = url_for('export_status', job_id=job.id)
+        response = jsonify({'job_id': job.id, 'status_url': status_url})
+        response.status_code = 202
+        response.headers['Location'] = status_url
+        response.headers['Refresh'] = f'1; url={status_url}'
+        return response
     
-    for t in transactions:
-        writer.writerow([
-            t.date.strftime('%Y-%m-%d'),
-            t.category,
-            t.description,
-            f'{t.amount:.2f}'
-        ])
+    # Without a worker, stream the CSV row by row instead of building it in memory
+    filename = f"finwise_export_{datetime.now().strftime('%Y%m%d')}.csv"
+    return Response(stream_with_context(generate_csv(uid)),
+                    mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/export_data/<uuid:job_id>')
+@login_required
+def export_status(job_id):
+    if 'celery' not in app.extensions:
+        abort(404)
+    
+    job_id = str(job_id)
+    
+    # Unknown, expired and other users' jobs all look the same
+    if cache.get(f'export:{job_id}') != current_user.id:
+        abort(404)
+    
+    job = AsyncResult(job_id)
+    
+    if not job.ready():
+        # Browsers following the download link poll via the Refresh header
+        response = jsonify({'job_id': job_id, 'status': job.status.lower()})
+        response.status_code = 202
+        response.headers['Refresh'] = '2'
+        return response
+    
+    cache.delete(f'export:{job_id}')
+    
+    if job.failed():
+        flash('Export failed, please try again', 'error')
+        return redirect(url_for('expenses'))
     
-    output = make_response(si.getvalue())
-    output.headers["Content-Disposition"] = f"attachment; filename=finwise_export_{datetime.now().strftime('%Y%m%d')}.csv"
-    output.headers["Content-type"] = "text/csv"
+    # Open before responding so a missing file is a 404, not an empty 200
+    path = export_path(job_id)
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        abort(404)
     
-    return output
+    # Each export is downloaded once, then removed from disk
+    def generate():
+        try:
+            with f:
+                yield from iter(lambda: f.read(64 * 1024), b'')
+        finally:
+            # A concurrent download of the same job may have removed it already
+            with suppress(FileNotFoundError):
+                os.remove(path)
+    
+    filename = f"finwise_export_{datetime.now().strftime('%Y%m%d')}.csv"
+    return Response(generate(),
+                    mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 # API Routes for AJAX requests
 @app.route('/api/transactions')
 @login_required
 def api_transactions():
-    transactions = Transaction.query.filter_by(user_id=current_user.id)\
-        .order_by(Transaction.date.desc()).all()
-    return jsonify([t.to_dict() for t in transactions])
+    uid = current_user.id
+    
+    etag = transactions_etag(uid, *get_transactions_version(uid))
+    if request.if_none_match.contains(etag):
+        return set_cache_headers(Response(status=304), etag)
+    
+    transactions = get_transactions(uid)
+    
+    # Serialize one transaction at a time rather than building the whole list
+    def generate():
+        yield '['
+        for i, t in enumerate(transactions):
+            yield (',' if i else '') + app.json.dumps(t.to_dict())
+        yield ']'
+    
+    response = Response(stream_with_context(generate()), mimetype='application/json')
+    return set_cache_headers(response, etag)
 
 @app.route('/api/dashboard_data')
 @login_required
 def api_dashboard_data():
-    transactions = Transaction.query.filter_by(user_id=current_user.id).all()
+    uid = current_user.id
     
-    # Category breakdown
-    categories = {}
-    for t in transactions:
-        categories[t.category] = categories.get(t.category, 0) + t.amount
+    # Build the ETag and the summary cache key from the same snapshot so the
+    # body always matches the ETag. The monthly windows move with the date.
+    version = get_transactions_version(uid)
+    today = date.today()
+    etag = transactions_etag(uid, *version, today)
+    if request.if_none_match.contains(etag):
+        return set_cache_headers(Response(status=304), etag)
+    
+    summary = get_spending_summary(uid, version, today)
+    categories = summary['categories']
+    month_totals = summary['by_month']
     
     # Monthly data (last 6 months)
     months = []
@@ -271,15 +519,11 @@ def api_dashboard_data():
     savings = []
     
     for i in range(5, -1, -1):
-        month_date = datetime.now() - timedelta(days=30*i)
+        month_date = today - timedelta(days=30*i)
         months.append(month_date.strftime('%b'))
         
-        # Mock data for earnings and calculate real spending
-        monthly_transactions = [t for t in transactions 
-                              if t.date.month == month_date.month 
-                              and t.date.year == month_date.year]
-        
-        month_spending = sum(t.amount for t in monthly_transactions)
+        # Mock data for earnings and look up real spending
+        month_spending = month_totals.get((month_date.year, month_date.month), 0)
         month_earnings = month_spending + (1000 + i * 100)  # Mock earnings
         month_savings = month_earnings - month_spending
         
@@ -287,13 +531,15 @@ def api_dashboard_data():
         spending.append(month_spending)
         savings.append(month_savings)
     
-    return jsonify({
+    response = jsonify({
         'categories': categories,
         'months': months,
         'earnings': earnings,
         'spending': spending,
         'savings': savings
     })
+    return set_cache_headers(response, etag)
 
 if __name__ == '__main__':
+    # Development server only, use gunicorn in production (see gunicorn.conf.py)
     app.run(debug=True)
\ No newline at end of file
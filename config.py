@@ -1,11 +1,36 @@
 import os
 from datetime import timedelta
+from redis import Redis
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///finwise.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_pre_ping': True,
+        'pool_recycle': 1800
+    }
+    if not SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+        # Reuse connections across requests instead of connecting per request
+        SQLALCHEMY_ENGINE_OPTIONS.update(pool_size=10, max_overflow=20)
     PERMANENT_SESSION_LIFETIME = timedelta(days=7)
+    
+    REDIS_URL = os.environ.get('REDIS_URL')
+    
+    # Use Redis when available so every worker shares the cache
+    CACHE_REDIS_URL = REDIS_URL
+    CACHE_TYPE = 'RedisCache' if REDIS_URL else 'SimpleCache'
+    
+    # Keep sessions server-side in Redis when available, otherwise use signed cookies
+    SESSION_TYPE = 'redis' if REDIS_URL else None
+    SESSION_REDIS = Redis.from_url(REDIS_URL) if REDIS_URL else None
+    
+    # Background jobs (CSV export) run on Celery when Redis is available
+    CELERY = {
+        'broker_url': REDIS_URL,
+        'result_backend': REDIS_URL,
+        'result_expires': timedelta(hours=1)
+    }
 
 # ==================== models.py ====================
 from flask_sqlalchemy import SQLAlchemy
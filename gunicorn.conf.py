@@ -0,0 +1,20 @@
+# Production server config, start with: gunicorn -c gunicorn.conf.py app:app
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+
+# Views are I/O-bound (database round trip, then template render), so each
+# worker serves several requests at once on threads
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Import the app once in the master so workers start already initialised
+preload_app = True
+
+def post_fork(server, worker):
+    # Don't share the master's pooled database connections with the workers
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
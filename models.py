@@ -1,9 +1,12 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 from datetime import datetime
 
 db = SQLAlchemy()
+password_hasher = PasswordHasher()
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
@@ -16,19 +19,35 @@ class User(UserMixin, db.Model):
     
     # Relationships
     transactions = db.relationship('Transaction', backref='user', lazy=True, cascade='all, delete-orphan')
-    settings = db.relationship('UserSettings', backref='user', uselist=False, cascade='all, delete-orphan')
+    settings = db.relationship('UserSettings', backref='user', uselist=False, lazy='joined', cascade='all, delete-orphan')
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not self.password_hash.startswith('$argon2'):
+            # Accounts created before the switch to argon2 use werkzeug's
+            # generate_password_hash (scrypt or pbkdf2)
+            return check_password_hash(self.password_hash, password)
+        try:
+            return password_hasher.verify(self.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    
+    def password_needs_rehash(self):
+        if not self.password_hash.startswith('$argon2'):
+            return True
+        return password_hasher.check_needs_rehash(self.password_hash)
     
     def __repr__(self):
         return f'<User {self.email}>'
 
 class Transaction(db.Model):
     __tablename__ = 'transactions'
+    __table_args__ = (
+        # Covers the per-user lookups, which are ordered by date
+        db.Index('ix_transactions_user_id_date', 'user_id', 'date'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -44,7 +63,7 @@ class Transaction(db.Model):
             'amount': self.amount,
             'category': self.category,
             'description': self.description,
-            'date': self.date.strftime('%Y-%m-%d'),
+            'date': self.date.isoformat(),
             'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S')
         }
     
@@ -55,7 +74,7 @@ class UserSettings(db.Model):
     __tablename__ = 'user_settings'
     
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     budget_alerts = db.Column(db.Boolean, default=True)
     weekly_summary = db.Column(db.Boolean, default=True)
     security_alerts = db.Column(db.Boolean, default=False)